@@ -6,8 +6,7 @@ from typing import Callable
 import daemon.pidfile as pidfile  # type: ignore[import-untyped]
 
 import wso.cli as cli
-from wso.config import HYPERVISOR_URL, WORKDIR
-from wso.server import Server
+from wso.config import HYPERVISOR_URL, WORKDIR, validate_paths
 
 
 def daemonize(func: Callable[[], None]) -> None:
@@ -46,6 +45,10 @@ if __name__ == "__main__":
         if args.args:
             print("Usage: wso start")
             exit(1)
+        # only the daemon needs libvirt and the management helpers
+        from wso.server import Server
+
+        validate_paths()
         server = Server(
             workdir=WORKDIR,
             hypervisor_url=HYPERVISOR_URL,
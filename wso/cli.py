@@ -1,24 +1,27 @@
-import asyncio
+import socket
 
 import wso.config as config
 
 
-async def send_msg_to_daemon(message: str) -> str:
-    reader, writer = await asyncio.open_connection(config.SERVER_HOST, config.SERVER_PORT)
-
-    writer.write(message.encode())
-    await writer.drain()
-
-    status = await reader.readline()
-    if status.decode().strip() != "OK":
-        data = await reader.read(256 * 1024)
-        raise RuntimeError(f"Daemon returned error: {status.decode().strip()}, {data.decode().strip()}")
-    data = await reader.read()
-
-    writer.close()
-    await writer.wait_closed()
-    return data.decode().strip()
+def _connect() -> socket.socket:
+    if config.SERVER_UNIX_PATH.exists():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(config.SERVER_UNIX_PATH))
+            return sock
+        except OSError:
+            sock.close()
+    return socket.create_connection((config.SERVER_HOST, config.SERVER_PORT))
 
 
 def send_msg(msg: str) -> str:
-    return asyncio.run(send_msg_to_daemon(msg))
+    # plain blocking socket - a one-shot request doesn't need an event loop
+    with _connect() as sock:
+        sock.sendall(msg.encode() + b"\n")
+        with sock.makefile("rb") as f:
+            status = f.readline()
+            if status.decode().strip() != "OK":
+                data = f.read(256 * 1024)
+                raise RuntimeError(f"Daemon returned error: {status.decode().strip()}, {data.decode().strip()}")
+            data = f.read()
+    return data.decode().strip()
@@ -3,18 +3,21 @@ from pathlib import Path
 
 from dotenv import find_dotenv, load_dotenv
 
-load_dotenv(find_dotenv())
+# find_dotenv walks up from cwd on every import, skip it when the environment is already set up
+if not os.getenv("WSO_NO_DOTENV"):
+    load_dotenv(find_dotenv())
 
 HYPERVISOR_URL = os.getenv("HYPERVISOR_URL", "qemu:///system")
 ISO_PATH = Path(os.getenv("ISO_PATH", ""))
-assert ISO_PATH.is_file(), f"ISO_PATH {ISO_PATH} does not exist or is not a file."
 QEMU_BINARY_PATH = Path(os.getenv("QEMU_BINARY_PATH", "/usr/bin/qemu-system-x86_64"))
-assert QEMU_BINARY_PATH.is_file(), f"QEMU_BINARY_PATH {QEMU_BINARY_PATH} does not exist or is not a file."
 PHYSICAL_IFACE_NAME = os.getenv("PHYSICAL_IFACE_NAME", "eth0")
 WORKDIR = Path(os.getenv("WORKDIR", "/tmp/wso-scaler"))
-WORKDIR.mkdir(parents=True, exist_ok=True)
 VM_SETUP_SCRIPT_PATH = os.getenv("VM_SETUP_SCRIPT_PATH", "NOTSET")
 SSH_KEY_PATH = os.getenv("SSH_KEY_PATH", None)
+# have libvirt validate generated domain/network XML against its schema, useful when debugging templates
+VALIDATE_XML = os.getenv("VALIDATE_XML", "0") == "1"
+# number of blank VM disks kept ready in WORKDIR/pool, 0 disables the pool
+DISK_POOL_SIZE = int(os.getenv("DISK_POOL_SIZE", "2"))
 
 HEALTHCHECK_PORT = int(os.getenv("HEALTHCHECK_PORT", "5000"))
 HEALTHCHECK_START_DELAY = int(os.getenv("HEALTHCHECK_START_DELAY", "600"))
@@ -33,6 +36,24 @@ UP_THRESHOLD = float(os.getenv("UP_THRESHOLD", "0.5"))
 DOWN_THRESHOLD = float(os.getenv("DOWN_THRESHOLD", "0.5"))
 CPU_LOAD_CHECK = int(os.getenv("CPU_LOAD_CHECK", "10"))
 CPU_CHECK_WINDOWSIZE = int(os.getenv("CPU_CHECK_WINDOWSIZE", "10"))
+# seconds to wait after a state change before reconciling, so bursts of changes are handled in one pass
+STATE_CHANGE_DEBOUNCE = float(os.getenv("STATE_CHANGE_DEBOUNCE", "0.05"))
+# how many domains are launched, and separately destroyed, at the same time
+DOMAIN_WORKERS = int(os.getenv("DOMAIN_WORKERS", "8"))
+# seconds between attempts to reconnect to libvirtd, doubled after each failure up to the max
+RECONNECT_BACKOFF = float(os.getenv("RECONNECT_BACKOFF", "1"))
+RECONNECT_BACKOFF_MAX = float(os.getenv("RECONNECT_BACKOFF_MAX", "60"))
 
 SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "9124"))
+SERVER_UNIX_PATH = Path(os.getenv("SERVER_UNIX_PATH", WORKDIR / "wso.sock"))
+
+
+def validate_paths() -> None:
+    """
+    Checks paths the daemon depends on and creates the workdir. Kept out of module import so that
+    short-lived CLI commands talking to an already running daemon don't pay for it.
+    """
+    assert ISO_PATH.is_file(), f"ISO_PATH {ISO_PATH} does not exist or is not a file."
+    assert QEMU_BINARY_PATH.is_file(), f"QEMU_BINARY_PATH {QEMU_BINARY_PATH} does not exist or is not a file."
+    WORKDIR.mkdir(parents=True, exist_ok=True)
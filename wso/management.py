@@ -1,28 +1,52 @@
 import asyncio
+import itertools
 import os
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from pathlib import Path
+from typing import Any, Callable, TypeVar
+from xml.sax.saxutils import escape
 
 import libvirt
 
-from wso.config import QEMU_BINARY_PATH, SSH_KEY_PATH, VM_SETUP_SCRIPT_PATH, WORKDIR
+from wso.config import DISK_POOL_SIZE, QEMU_BINARY_PATH, SSH_KEY_PATH, VALIDATE_XML, VM_SETUP_SCRIPT_PATH, WORKDIR
 from wso.utils import get_ssh_public_key
 
+_T = TypeVar("_T")
 
-def _get_domain_xml(
-    name: str,
-    n_cpus: int,
-    memory_kib: int,
-    network_name: str,
-    iso_path: str | os.PathLike,
-    cloud_init_iso_path: str | os.PathLike,
-) -> str:
-    domain_xml = f"""
+# libvirt RPCs block, keep them off the event loop but cap how many hit libvirtd at once
+_LIBVIRT_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="libvirt")
+
+
+async def run_libvirt(func: Callable[..., _T], *args: Any, **kwargs: Any) -> _T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_LIBVIRT_EXECUTOR, partial(func, *args, **kwargs))
+
+
+def shutdown_libvirt_executor() -> None:
+    _LIBVIRT_EXECUTOR.shutdown(wait=True)
+
+
+# handles returned by launch_domain, so destroy_domain can skip the lookupByName round-trip
+_DOMAINS: dict[str, libvirt.virDomain] = {}
+
+
+def _xml_escape(value: str | os.PathLike) -> str:
+    # values end up in both element text and quoted attributes
+    return escape(os.fspath(value), {"'": "&apos;", '"': "&quot;"})
+
+
+# resolved once at import rather than with realpath syscalls on every launch
+_QEMU_BINARY = _xml_escape(QEMU_BINARY_PATH.resolve().absolute())
+_WORKDIR = _xml_escape(WORKDIR.resolve().absolute())
+
+_DOMAIN_XML_TEMPLATE = """
   <domain type='kvm'>
-    <name>{name}</name>
-    <memory>{memory_kib}</memory>
-    <vcpu>{n_cpus}</vcpu>
+    <name>%(name)s</name>
+    <memory>%(memory_kib)d</memory>
+    <vcpu>%(n_cpus)d</vcpu>
     <os>
       <type arch="x86_64">hvm</type>
       <boot dev='cdrom'/>
@@ -34,26 +58,26 @@ def _get_domain_xml(
     </features>
     <clock sync="localtime"/>
     <devices>
-      <emulator>{QEMU_BINARY_PATH.resolve().absolute()}</emulator>
+      <emulator>%(emulator)s</emulator>
       <disk type='file' device='cdrom'>
         <driver name='qemu' type='raw'/>
-        <source file='{iso_path}'/>
+        <source file='%(iso_path)s'/>
         <target dev='hdc' bus='ide'/>
         <readonly/>
       </disk>
       <disk type='file' device='cdrom'>
         <driver name='qemu' type='raw'/>
-        <source file='{cloud_init_iso_path}'/>
+        <source file='%(cloud_init_iso_path)s'/>
         <target dev='hdd' bus='ide'/>
         <readonly/>
       </disk>
       <disk type='file' device='disk'>
         <driver name='qemu' type='qcow2'/>
-        <source file='{WORKDIR.resolve().absolute()}/wso-{name}-disk.qcow2'/>
+        <source file='%(workdir)s/wso-%(name)s-disk.qcow2'/>
         <target dev='vda' bus='virtio'/>
       </disk>
       <interface type='network'>
-        <source network='{network_name}'/>
+        <source network='%(network_name)s'/>
         <model type='virtio'/>
       </interface>
       <graphics type='vnc' port='-1' listen='127.0.0.1'/>
@@ -66,31 +90,111 @@ def _get_domain_xml(
     </devices>
   </domain>
   """
-    return domain_xml
-
 
-def _get_network_xml(name: str, bridge_name: str, subnet: str = "192.168.100") -> str:
-    network_xml = f"""
+_NETWORK_XML_TEMPLATE = """
     <network>
-        <name>{name}</name>
+        <name>%(name)s</name>
         <forward mode="nat">
             <nat>
                 <port start="1024" end="65535"/>
             </nat>
         </forward>
-        <bridge name="{bridge_name}" stp="on" delay="0"/>
-        <ip address="{subnet}.1" netmask="255.255.255.0"/>
+        <bridge name="%(bridge_name)s" stp="on" delay="0"/>
+        <ip address="%(subnet)s.1" netmask="255.255.255.0"/>
     </network>
     """
-    return network_xml
 
 
-async def create_disk_image(domain_name: str, size_gb: int = 1) -> Path:
+def _get_domain_xml(
+    name: str,
+    n_cpus: int,
+    memory_kib: int,
+    network_name: str,
+    iso_path: str | os.PathLike,
+    cloud_init_iso_path: str | os.PathLike,
+) -> str:
+    return _DOMAIN_XML_TEMPLATE % {
+        "name": _xml_escape(name),
+        "memory_kib": memory_kib,
+        "n_cpus": n_cpus,
+        "iso_path": _xml_escape(iso_path),
+        "cloud_init_iso_path": _xml_escape(cloud_init_iso_path),
+        "emulator": _QEMU_BINARY,
+        "workdir": _WORKDIR,
+        "network_name": _xml_escape(network_name),
+    }
+
+
+def _get_network_xml(name: str, bridge_name: str, subnet: str = "192.168.100") -> str:
+    return _NETWORK_XML_TEMPLATE % {
+        "name": _xml_escape(name),
+        "bridge_name": _xml_escape(bridge_name),
+        "subnet": _xml_escape(subnet),
+    }
+
+
+async def _create_qcow2(path: Path, size_gb: int) -> None:
+    # disks are scratch space thrown away with the VM, so defer refcount updates instead of syncing them
+    process = await asyncio.create_subprocess_exec(
+        "qemu-img",
+        "create",
+        "-f",
+        "qcow2",
+        "-o",
+        "lazy_refcounts=on",
+        str(path),
+        f"{size_gb}G",
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to create disk image {path}: {stderr.decode().strip()}")
+
+
+class DiskPool:
+    """
+    Keeps a few blank disk images ready in the background, so that launching a domain only has to
+    rename one into place instead of waiting for qemu-img.
+    """
+
+    def __init__(self, size: int = DISK_POOL_SIZE, size_gb: int = 1):
+        self.size_gb = size_gb
+        self._dir = WORKDIR / "pool"
+        self._ready: asyncio.Queue[Path] = asyncio.Queue(maxsize=max(size, 1))
+        self._enabled = size > 0
+        self._counter = itertools.count()
+
+    def take(self, size_gb: int) -> Path | None:
+        if size_gb != self.size_gb:
+            return None
+        try:
+            return self._ready.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    async def refill_forever(self) -> None:
+        if not self._enabled:
+            return
+        await asyncio.to_thread(self._dir.mkdir, parents=True, exist_ok=True)
+        # images left over from a previous run are not tracked by the queue
+        for leftover in await asyncio.to_thread(list, self._dir.glob("*.qcow2")):
+            await asyncio.to_thread(leftover.unlink, missing_ok=True)
+        while True:
+            path = self._dir / f"disk-{next(self._counter)}.qcow2"
+            await _create_qcow2(path, self.size_gb)
+            # blocks while the pool is full
+            await self._ready.put(path)
+
+
+async def create_disk_image(domain_name: str, size_gb: int = 1, disk_pool: DiskPool | None = None) -> Path:
     """Create a qcow2 disk image for the VM"""
     disk_path = WORKDIR / f"wso-{domain_name}-disk.qcow2"
-    cmd = f"qemu-img create -f qcow2 {disk_path} {size_gb}G"
-    process = await asyncio.create_subprocess_shell(cmd)
-    await process.wait()
+    pooled_path = disk_pool.take(size_gb) if disk_pool is not None else None
+    if pooled_path is not None:
+        await asyncio.to_thread(os.rename, pooled_path, disk_path)
+    else:
+        await _create_qcow2(disk_path, size_gb)
     return disk_path
 
 
@@ -101,21 +205,22 @@ async def get_or_create_nat_network(
         raise ValueError(f"Bridge name '{bridge_name}' is too long (max 15 characters)")
 
     try:
-        existing_network = libvirt_connection.networkLookupByName(network_name)
+        existing_network = await run_libvirt(libvirt_connection.networkLookupByName, network_name)
         return existing_network
     except libvirt.libvirtError as e:
-        if "Network not found" not in str(e):
+        if e.get_error_code() != libvirt.VIR_ERR_NO_NETWORK:
             raise
     network_xml = _get_network_xml(network_name, bridge_name, subnet)
-    network = await asyncio.to_thread(partial(libvirt_connection.networkCreateXML, network_xml))
+    flags = libvirt.VIR_NETWORK_CREATE_VALIDATE if VALIDATE_XML else 0
+    network = await run_libvirt(libvirt_connection.networkCreateXMLFlags, network_xml, flags)
     if not network:
         raise SystemExit(f"Failed to create network {network_name}")
     return network
 
 
 async def destroy_nat_network(libvirt_connection: libvirt.virConnect, network_name: str) -> None:
-    network = libvirt_connection.networkLookupByName(network_name)
-    await asyncio.to_thread(network.destroy)
+    network = await run_libvirt(libvirt_connection.networkLookupByName, network_name)
+    await run_libvirt(network.destroy)
 
 
 async def launch_domain(
@@ -126,10 +231,13 @@ async def launch_domain(
     network_name: str,
     iso_path: str | os.PathLike,
     static_ip: str,
+    disk_pool: DiskPool | None = None,
 ) -> libvirt.virDomain:
-    await create_disk_image(name)
-
-    cloud_init_iso_path = await create_cloud_init_iso(name, static_ip)
+    # both are independent subprocesses, run them side by side
+    _, cloud_init_iso_path = await asyncio.gather(
+        create_disk_image(name, disk_pool=disk_pool),
+        create_cloud_init_iso(name, static_ip),
+    )
 
     domain_xml = _get_domain_xml(
         name=name,
@@ -139,43 +247,43 @@ async def launch_domain(
         iso_path=str(iso_path),
         cloud_init_iso_path=cloud_init_iso_path,
     )
-    dom = await asyncio.to_thread(partial(libvirt_connection.createXML, xmlDesc=domain_xml))
+    # no VIR_DOMAIN_START_AUTODESTROY, it would take every domain down whenever the server
+    # replaces its libvirt connection
+    flags = libvirt.VIR_DOMAIN_START_VALIDATE if VALIDATE_XML else 0
+    dom = await run_libvirt(libvirt_connection.createXML, xmlDesc=domain_xml, flags=flags)
     if not dom:
         raise SystemExit("Failed to create a domain from an XML definition")
+    _DOMAINS[name] = dom
     return dom
 
 
 async def destroy_domain(libvirt_connection: libvirt.virConnect, name: str) -> None:
-    dom = libvirt_connection.lookupByName(name)
-    if not dom:
-        raise SystemExit(f"Domain {name} not found")
-
-    await asyncio.to_thread(dom.destroy)
+    dom = _DOMAINS.pop(name, None)
+    try:
+        # a handle from a connection that has since been replaced is no good
+        if dom is None or dom.connect() is not libvirt_connection:
+            dom = await run_libvirt(libvirt_connection.lookupByName, name)
+        await run_libvirt(dom.destroy)
+    except libvirt.libvirtError as e:
+        # transient domains disappear once they stop, so there is nothing left to destroy
+        if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+            raise
 
     disk_path = WORKDIR / f"wso-{name}-disk.qcow2"
-    if os.path.exists(disk_path):
-        os.remove(disk_path)
-
     cloud_init_iso_path = WORKDIR / f"wso-{name}-cloud-init.iso"
-    if os.path.exists(cloud_init_iso_path):
-        os.remove(cloud_init_iso_path)
-
-
-# DUMMY FUNCTION FOR DEBUGGING - to be replaced with actual health check
-def is_domain_active(libvirt_connection: libvirt.virConnect, name: str) -> bool:
-    dom = libvirt_connection.lookupByName(name)
-    return dom.isActive()  # type: ignore[no-any-return]
+    await asyncio.gather(
+        asyncio.to_thread(disk_path.unlink, missing_ok=True),
+        asyncio.to_thread(cloud_init_iso_path.unlink, missing_ok=True),
+    )
 
 
-async def create_cloud_init_iso(domain_name: str, static_ip: str, gateway: str = "192.168.100.1") -> Path:
-    with tempfile.TemporaryDirectory() as temp_dir:
-        meta_data = f"""instance-id: {domain_name}
-local-hostname: {domain_name}
+_META_DATA_TEMPLATE = """instance-id: %(domain_name)s
+local-hostname: %(domain_name)s
 """
 
-        # Create user-data file with network configuration
-        user_data = f"""#cloud-config
-hostname: {domain_name}
+# user-data with network configuration
+_USER_DATA_TEMPLATE = """#cloud-config
+hostname: %(domain_name)s
 manage_etc_hosts: true
 
 # Network configuration
@@ -187,9 +295,9 @@ write_files:
 
       auto eth0
       iface eth0 inet static
-          address {static_ip}
+          address %(static_ip)s
           netmask 255.255.255.0
-          gateway {gateway}
+          gateway %(gateway)s
     permissions: '0644'
 
   - path: /etc/resolv.conf
@@ -199,7 +307,7 @@ write_files:
     permissions: '0644'
 
 runcmd:
-  - hostname {domain_name}
+  - hostname %(domain_name)s
   - ifdown eth0 || true
   - ifup eth0
   - setup-apkrepos -c -1
@@ -208,20 +316,33 @@ runcmd:
   - apk add openssh-server
   - mv /tmp/index.html /var/lib/nginx/html/index.html
   - ssh-keygen -t ed25519 -q -f "/root/.ssh/id_ed25519" -N ""
-  - echo "{get_ssh_public_key()}" >> /root/.ssh/authorized_keys
+  - echo "%(ssh_public_key)s" >> /root/.ssh/authorized_keys
   - touch /initialized
 
-final_message: "Cloud-init configuration completed for {domain_name}"
+final_message: "Cloud-init configuration completed for %(domain_name)s"
 """
 
+
+async def create_cloud_init_iso(domain_name: str, static_ip: str, gateway: str = "192.168.100.1") -> Path:
+    meta_data = _META_DATA_TEMPLATE % {"domain_name": domain_name}
+    user_data = _USER_DATA_TEMPLATE % {
+        "domain_name": domain_name,
+        "static_ip": static_ip,
+        "gateway": gateway,
+        "ssh_public_key": get_ssh_public_key(),
+    }
+
+    # creating and removing the temp dir touches the filesystem too, keep it off the event loop
+    temp_dir = await asyncio.to_thread(tempfile.mkdtemp)
+    try:
         meta_data_path = os.path.join(temp_dir, "meta-data")
         user_data_path = os.path.join(temp_dir, "user-data")
 
-        with open(meta_data_path, "w") as f:
-            f.write(meta_data)
-
-        with open(user_data_path, "w") as f:
-            f.write(user_data)
+        # blocking writes go to worker threads so concurrent launches don't stall the event loop
+        await asyncio.gather(
+            asyncio.to_thread(Path(meta_data_path).write_text, meta_data),
+            asyncio.to_thread(Path(user_data_path).write_text, user_data),
+        )
 
         iso_path = WORKDIR / f"wso-{domain_name}-cloud-init.iso"
         cmd = [
@@ -243,6 +364,30 @@ final_message: "Cloud-init configuration completed for {domain_name}"
             raise RuntimeError(f"Failed to create cloud-init ISO: {process.returncode}")
 
         return Path(iso_path)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+
+
+_SSH_OPTIONS = [
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "PasswordAuthentication=no",
+    "-o",
+    "PreferredAuthentications=publickey",
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+    "-o",
+    "BatchMode=yes",
+    # scp and the following ssh share one master connection instead of two handshakes
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    f"ControlPath={WORKDIR.resolve().absolute()}/ssh-%C",
+    "-o",
+    "ControlPersist=30",
+    *(["-i", SSH_KEY_PATH] if SSH_KEY_PATH else []),
+]
 
 
 async def configure_domain(
@@ -250,16 +395,23 @@ async def configure_domain(
     user: str = "root",
     config_script_file: str | os.PathLike = VM_SETUP_SCRIPT_PATH,
 ) -> None:
-    proc = await asyncio.create_subprocess_shell(
-        f"scp -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o PreferredAuthentications=publickey -o UserKnownHostsFile=/dev/null -o 'BatchMode=yes' -i {SSH_KEY_PATH} {config_script_file} {user}@{ip}:/setup.sh",
+    proc = await asyncio.create_subprocess_exec(
+        "scp",
+        *_SSH_OPTIONS,
+        os.fspath(config_script_file),
+        f"{user}@{ip}:/setup.sh",
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
     stdout, stderr = await proc.communicate()
     if proc.returncode != 0:
         raise RuntimeError(f"Failed to copy setup script to {ip}: {stderr.decode().strip()}")
-    proc = await asyncio.create_subprocess_shell(
-        f"ssh -t -o StrictHostKeyChecking=no -o PasswordAuthentication=no -o PreferredAuthentications=publickey -o UserKnownHostsFile=/dev/null -o 'BatchMode=yes' -i {SSH_KEY_PATH} {user}@{ip} 'sh /setup.sh > tee /setup.log'",
+    proc = await asyncio.create_subprocess_exec(
+        "ssh",
+        "-t",
+        *_SSH_OPTIONS,
+        f"{user}@{ip}",
+        "sh /setup.sh > tee /setup.log",
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
@@ -5,28 +5,32 @@ import contextlib
 import datetime
 import enum
 import errno
-import functools
 import json
 import logging
 import os
 import random
+import secrets
+import socket
 import sys
 from collections import deque
 from dataclasses import dataclass
-from functools import partial
+from functools import cached_property, partial
 from pathlib import Path
-from typing import AsyncGenerator, TypedDict
-from uuid import uuid4
+from typing import AsyncGenerator, Awaitable, Callable, TypedDict
 
 import libvirt
+import libvirtaio
 
 import wso.config as config
 from wso.management import (
+    DiskPool,
     configure_domain,
     destroy_domain,
     destroy_nat_network,
     get_or_create_nat_network,
     launch_domain,
+    run_libvirt,
+    shutdown_libvirt_executor,
 )
 from wso.utils import EnhancedJSONEncoder, get_logger
 
@@ -64,7 +68,7 @@ class Domain:
     started_at: datetime.datetime | None
 
     def __init__(self, n_cpus: int, memory_kib: int, iso_path: Path, ip_address: str, ip_subnet: str):
-        self.domain_id = str(uuid4())[:8]
+        self.domain_id = secrets.token_hex(4)
 
         self.domain_name = f"wso-{self.domain_id}"
         self.network_name = "wso-net"
@@ -84,12 +88,17 @@ class Domain:
 class HealthCheckFailureException(Exception): ...
 
 
+_OK = b"OK\n"
+_ERROR = b"ERROR\n"
+# control commands are one short line, anything longer or slower is not a client of ours
+_MAX_COMMAND_BYTES = 128
+_COMMAND_TIMEOUT_S = 2.0
+
+
 class Server:
     _state: ServerState
     _state_changed = asyncio.Event()
 
-    _healthcheck_tasks: dict[str, asyncio.Task[None]] = {}
-
     _desired_num_vms = 2
 
     def __init__(self, workdir: Path, hypervisor_url: str):
@@ -110,35 +119,77 @@ class Server:
 
         self._cpu_usage_window = deque(maxlen=config.CPU_CHECK_WINDOWSIZE)
 
+        # domain names bucketed by state, so reconciliation doesn't have to scan every domain;
+        # kept in sync by _add_domain, _remove_domain and _set_domain_state
+        self._domains_by_state: dict[DomainState, set[str]] = {state: set() for state in DomainState}
+        # host addresses not taken by any domain, .1 is the bridge; released ones go to the back
+        self._free_ips = deque(f"192.168.100.{ip_suffix}" for ip_suffix in range(2, 255))
+
+        self._conn: libvirt.virConnect | None = None
+        self._conn_lock = asyncio.Lock()
+        self._conn_closed = asyncio.Event()
+
+        self._disk_pool = DiskPool()
+
+        # serialized state reused by "state" requests until something changes
+        self._state_bytes: bytes | None = None
+
+        # launches and destroys are picked up by a fixed set of workers instead of a task per domain
+        self._launch_queue: asyncio.Queue[Domain] = asyncio.Queue()
+        self._destroy_queue: asyncio.Queue[Domain] = asyncio.Queue()
+        # configure tasks by domain name, cancelled once their domain is on its way out
+        self._configure_tasks: dict[str, asyncio.Task[None]] = {}
+        self._jobs_task: asyncio.Task[object] | None = None
+
+        self._mark_dirty()
+
+    @cached_property
+    def logger(self) -> logging.Logger:
+        # created on first use inside serve_forever, after the daemon has forked; a log listener
+        # thread started in the parent would not exist in the child
+        return get_logger(log_file=self.workdir / "server.log", level=logging.DEBUG)
+
+    def _mark_dirty(self) -> None:
+        self._state_bytes = None
         self._state_changed.set()
 
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> bytes | None:
+        try:
+            async with asyncio.timeout(_COMMAND_TIMEOUT_S):
+                return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # client shut down its side without a trailing newline
+            return e.partial
+        except (asyncio.LimitOverrunError, TimeoutError):
+            return None
+
     async def handle_msg(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-        data = await reader.read(1024)
-        message = data.decode()
-
-        self.logger.debug(f"Received msg {message!r}")
-
-        if message.strip() == "state":
-            response = json.dumps(self._state, cls=EnhancedJSONEncoder)
-            writer.write("OK\n".encode())
-            writer.write(response.encode())
-        elif message.startswith("scale "):
-            n_vms_str = message.split()[1]
-            if not n_vms_str.isnumeric() or not (1 <= int(n_vms_str) <= 100):
-                response = "Expected integer <1,100>"
-                writer.write("ERROR\n".encode())
-                writer.write(response.encode())
+        data = await self._read_command(reader)
+        # commands are plain ASCII, parse them as bytes and only decode for error messages
+        message = data.strip() if data is not None else None
+
+        self.logger.debug("Received msg %r", message)
+
+        if message is None:
+            self.logger.warning("Received an oversized or unterminated message")
+            writer.writelines((_ERROR, b"Expected a newline-terminated command"))
+        elif message == b"state":
+            if self._state_bytes is None:
+                self._state_bytes = json.dumps(self._state, cls=EnhancedJSONEncoder).encode()
+            writer.writelines((_OK, self._state_bytes))
+        elif message.startswith(b"scale "):
+            n_vms = message.split()[1]
+            if not n_vms.isdigit() or not (1 <= int(n_vms) <= 100):
+                writer.writelines((_ERROR, b"Expected integer <1,100>"))
             else:
-                self._desired_num_vms = int(n_vms_str)
-                response = f"Scale to {self._desired_num_vms}"
-                writer.write("OK\n".encode())
-                writer.write(response.encode())
-                self._state_changed.set()
+                self._desired_num_vms = int(n_vms)
+                writer.writelines((_OK, f"Scale to {self._desired_num_vms}".encode()))
+                self._mark_dirty()
         else:
-            self.logger.warning(f"Unknown message received: {message!r}")
-            response = f"Unknown command: {message!r}"
-            writer.write("ERROR\n".encode())
-            writer.write(response.encode())
+            message_str = message.decode(errors="replace")
+            self.logger.warning(f"Unknown message received: {message_str!r}")
+            writer.writelines((_ERROR, f"Unknown command: {message_str!r}".encode()))
 
         await writer.drain()
 
@@ -146,56 +197,129 @@ class Server:
         await writer.wait_closed()
 
     async def run_server(self) -> None:
-        server = await asyncio.start_server(self.handle_msg, config.SERVER_HOST, config.SERVER_PORT)
+        server = await asyncio.start_server(
+            self.handle_msg, config.SERVER_HOST, config.SERVER_PORT, limit=_MAX_COMMAND_BYTES
+        )
+        # local CLI calls skip the loopback TCP stack when the unix socket is available
+        unix_server = await asyncio.start_unix_server(
+            self.handle_msg, config.SERVER_UNIX_PATH, limit=_MAX_COMMAND_BYTES
+        )
 
         addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-        self.logger.debug(f"Serving on TCP {addrs}")
+        self.logger.debug("Serving on TCP %s and unix socket %s", addrs, config.SERVER_UNIX_PATH)
 
-        async with server:
-            await server.serve_forever()
-
-    @property
-    @functools.lru_cache
-    def logger(self) -> logging.Logger:
-        return get_logger(log_file=self.workdir / "server.log", level=logging.DEBUG)
+        async with server, unix_server:
+            await asyncio.gather(server.serve_forever(), unix_server.serve_forever())
 
     @contextlib.asynccontextmanager
     async def connection_context(self) -> AsyncGenerator[libvirt.virConnect]:
-        conn = await asyncio.to_thread(partial(libvirt.open, self.hypervisor_url))
-        if not conn:
-            raise libvirt.libvirtError(f"Failed to open connection to {self.hypervisor_url}")
-        try:
-            yield conn
-        finally:
-            if conn:
-                await asyncio.to_thread(conn.close)
+        # one connection is shared by all operations and reopened lazily if libvirtd drops it
+        async with self._conn_lock:
+            if self._conn is not None and not self._conn.isAlive():
+                self.logger.warning(f"Connection to {self.hypervisor_url} is dead, reconnecting")
+                await self._discard_connection()
+            if self._conn is None:
+                conn = await run_libvirt(libvirt.open, self.hypervisor_url)
+                if not conn:
+                    raise libvirt.libvirtError(f"Failed to open connection to {self.hypervisor_url}")
+                # keepalive lets libvirtaio notice a dead libvirtd and fire the close callback
+                await run_libvirt(conn.setKeepAlive, 5, 3)
+                # libvirt fires the callback from whichever thread notices the socket closing
+                conn.registerCloseCallback(self._on_connection_closed, asyncio.get_running_loop())
+                self._conn = conn
+                self._conn_closed.clear()
+            conn = self._conn
+        yield conn
+
+    def _on_connection_closed(self, conn: libvirt.virConnect, reason: int, loop: asyncio.AbstractEventLoop) -> None:
+        # usually a libvirt executor thread, asyncio objects may only be touched from the loop
+        loop.call_soon_threadsafe(self._connection_lost, conn, reason)
+
+    def _connection_lost(self, conn: libvirt.virConnect, reason: int) -> None:
+        if conn is not self._conn:
+            return
+        self.logger.warning(f"Connection to {self.hypervisor_url} closed (reason {reason}), reconnecting")
+        # wakes the lifecycle watcher, which releases the dead handle and reconnects
+        self._conn_closed.set()
+
+    async def _discard_connection(self, conn: libvirt.virConnect | None = None) -> None:
+        # caller must hold self._conn_lock; with conn given, only discard it if it's still the current one
+        if self._conn is None or (conn is not None and conn is not self._conn):
+            return
+        conn, self._conn = self._conn, None
+        self._conn_closed.set()
+        with contextlib.suppress(libvirt.libvirtError):
+            conn.unregisterCloseCallback()
+        with contextlib.suppress(libvirt.libvirtError):
+            await run_libvirt(conn.close)
+
+    async def _close_connection(self, conn: libvirt.virConnect | None = None) -> None:
+        async with self._conn_lock:
+            await self._discard_connection(conn)
 
     @staticmethod
     async def healthckeck_single(host: str, port: int, timeout_s: float = 1.0) -> None:
-        try:
-            future = asyncio.open_connection(host, port)
-            _, writer = await asyncio.wait_for(future, timeout=timeout_s)
-        except asyncio.TimeoutError as e:
-            exception_msg = f"Healthcheck failed: timeout after {timeout_s}s while connecting to {host}:{port}"
-            raise HealthCheckFailureException(exception_msg) from e
-        except OSError as e:
-            _errno, msg = e.args
-            exception_msg = f"Healthcheck failed: [Error {_errno}] {errno.errorcode.get(_errno, '??? Unknown error')}: {msg} while connecting to {host}:{port}"
-            raise HealthCheckFailureException(exception_msg) from e
-        writer.close()
-
-    # todo this is wrong
-    def _generate_static_ip(self, subnet: str = "192.168.100") -> str:
-        ip_suffix = random.randint(2, 254)
-        return f"{subnet}.{ip_suffix}"
+        loop = asyncio.get_running_loop()
+        # a bare non-blocking socket is enough to tell whether the port accepts connections,
+        # no need for the stream reader/writer/transport stack; closed on every path
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setblocking(False)
+            try:
+                async with asyncio.timeout(timeout_s):
+                    await loop.sock_connect(sock, (host, port))
+            except asyncio.TimeoutError as e:
+                exception_msg = f"Healthcheck failed: timeout after {timeout_s}s while connecting to {host}:{port}"
+                raise HealthCheckFailureException(exception_msg) from e
+            except OSError as e:
+                _errno, msg = e.args
+                exception_msg = f"Healthcheck failed: [Error {_errno}] {errno.errorcode.get(_errno, '??? Unknown error')}: {msg} while connecting to {host}:{port}"
+                raise HealthCheckFailureException(exception_msg) from e
+
+    def _add_domain(self, domain: Domain) -> None:
+        self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
+        self._domains_by_state[domain.state].add(domain.domain_name)
+        self._state_bytes = None
+
+    def _remove_domain(self, domain: Domain) -> None:
+        del self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name]
+        self._domains_by_state[domain.state].discard(domain.domain_name)
+        self._free_ips.append(domain.ip_address)
+        self._cancel_configure_task(domain)
+        self._state_bytes = None
+
+    def _cancel_configure_task(self, domain: Domain) -> None:
+        # stops scp/ssh to an address that is about to be released and reused
+        task = self._configure_tasks.pop(domain.domain_name, None)
+        if task is not None:
+            task.cancel()
+
+    def _set_domain_state(self, domain: Domain, state: DomainState) -> None:
+        # late updates for a domain that's already been removed must not put it back into a bucket
+        if self._state["hypervisors"][self.hypervisor_url]["domains"].get(domain.domain_name) is not domain:
+            return
+        self._domains_by_state[domain.state].discard(domain.domain_name)
+        domain.state = state
+        self._domains_by_state[state].add(domain.domain_name)
+        self._state_bytes = None
+
+    def _domains_in_state(self, *states: DomainState) -> list[Domain]:
+        domains = self._state["hypervisors"][self.hypervisor_url]["domains"]
+        return [domains[name] for state in states for name in self._domains_by_state[state] if name in domains]
+
+    def _generate_static_ip(self) -> str:
+        if not self._free_ips:
+            raise RuntimeError("No free IP addresses left in 192.168.100.0/24")
+        return self._free_ips.popleft()
 
     async def _configure_domain_task(self, domain: Domain) -> None:
         try:
             self.logger.debug(
-                f"Waiting {config.CONFIGURATION_INITIAL_DELAY}s for {domain.domain_name} to boot before attempting configuring..."
+                "Waiting %ss for %s to boot before attempting configuring...",
+                config.CONFIGURATION_INITIAL_DELAY,
+                domain.domain_name,
             )
             await asyncio.sleep(config.CONFIGURATION_INITIAL_DELAY)
-            self.logger.debug(f"Configuring domain {domain.domain_name} with static IP {domain.ip_address}...")
+            self.logger.debug("Configuring domain %s with static IP %s...", domain.domain_name, domain.ip_address)
 
             for _ in range(config.CONFIGURATION_RETRIES):
                 try:
@@ -205,9 +329,10 @@ class Server:
                     self.logger.error(f"Configuration failed for domain {domain.domain_name}: {e}")
                     await asyncio.sleep(config.CONFIGURATION_RETRY_INTERVAL)
             else:
-                domain.state = DomainState.UNHEALTHY
-                self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
-                self._state_changed.set()
+                # already on its way out, don't queue a second destroy
+                if domain.state is not DomainState.TERMINATING:
+                    self._set_domain_state(domain, DomainState.UNHEALTHY)
+                    self._mark_dirty()
                 raise RuntimeError(
                     f"Failed to configure domain {domain.domain_name} after {config.CONFIGURATION_RETRIES} retries"
                 )
@@ -219,7 +344,7 @@ class Server:
 
     async def launch_domain(self, domain: Domain) -> Domain:
         async with self.connection_context() as conn:
-            self.logger.debug(f"Getting NAT network {domain.network_name}...")
+            self.logger.debug("Getting NAT network %s...", domain.network_name)
             await get_or_create_nat_network(
                 libvirt_connection=conn,
                 network_name=domain.network_name,
@@ -227,7 +352,7 @@ class Server:
                 subnet="192.168.100",
             )
 
-            self.logger.debug(f"Launching domain {domain.domain_name}...")
+            self.logger.debug("Launching domain %s...", domain.domain_name)
             _ = await launch_domain(
                 libvirt_connection=conn,
                 name=domain.domain_name,
@@ -236,11 +361,17 @@ class Server:
                 network_name=domain.network_name,
                 iso_path=domain.iso_path,
                 static_ip=domain.ip_address,
+                disk_pool=self._disk_pool,
             )
             self.logger.info(f"Launched domain {domain.domain_name} with static IP {domain.ip_address}")
-            asyncio.create_task(self._configure_domain_task(domain=domain))
+            task = asyncio.create_task(
+                self._configure_domain_task(domain=domain), name=f"configure {domain.domain_name}"
+            )
+            # the loop only keeps weak references to tasks, hold on to it until it finishes
+            self._configure_tasks[domain.domain_name] = task
+            task.add_done_callback(lambda _: self._configure_tasks.pop(domain.domain_name, None))
 
-            domain.state = DomainState.HEALTHCHECK_INITIALIZING
+            self._set_domain_state(domain, DomainState.HEALTHCHECK_INITIALIZING)
             domain.started_at = datetime.datetime.now()
             return domain
 
@@ -250,7 +381,7 @@ class Server:
 
         async with self.connection_context() as conn:
             try:
-                self.logger.debug(f"Destroying domain {domain_name}...")
+                self.logger.debug("Destroying domain %s...", domain_name)
                 await destroy_domain(libvirt_connection=conn, name=domain_name)
                 self.logger.info(f"Destroyed domain {domain_name}")
             except Exception as e:
@@ -261,7 +392,7 @@ class Server:
     async def destroy_nat_network(self, network_name: str) -> None:
         async with self.connection_context() as conn:
             try:
-                self.logger.debug(f"Destroying NAT network {network_name}...")
+                self.logger.debug("Destroying NAT network %s...", network_name)
                 await destroy_nat_network(libvirt_connection=conn, network_name=network_name)
                 self.logger.info(f"Destroyed NAT network {network_name}")
             except Exception as e:
@@ -271,20 +402,22 @@ class Server:
 
     async def _get_average_cpu_utilization(self) -> float:
         async with self.connection_context() as conn:
-            domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
-            cpu_usages = []
-
-            for d in domains:
-                if d.isActive() == 1:
-                    try:
-                        prev_cpu_time = d.info()[4]
-                        await asyncio.sleep(1)
-                        curr_cpu_time = d.info()[4]
-                        cpu_delta = curr_cpu_time - prev_cpu_time
-                        cpu_usage = cpu_delta / 1e9
-                        cpu_usages.append(cpu_usage)
-                    except libvirt.libvirtError:
-                        continue
+            # one bulk stats call per sample for all domains instead of info() per domain
+            get_cpu_stats = partial(
+                conn.getAllDomainStats,
+                libvirt.VIR_DOMAIN_STATS_CPU_TOTAL,
+                libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE,
+            )
+            prev_stats = await run_libvirt(get_cpu_stats)
+            await asyncio.sleep(1)
+            curr_stats = await run_libvirt(get_cpu_stats)
+
+            prev_cpu_times = {d.name(): stats["cpu.time"] for d, stats in prev_stats if "cpu.time" in stats}
+            cpu_usages = [
+                (stats["cpu.time"] - prev_cpu_times[d.name()]) / 1e9
+                for d, stats in curr_stats
+                if "cpu.time" in stats and d.name() in prev_cpu_times
+            ]
 
             if not cpu_usages:
                 return 0.0
@@ -302,19 +435,19 @@ class Server:
                 self._cpu_usage_window.append(avg_cpu)
 
                 window_avg = sum(self._cpu_usage_window) / len(self._cpu_usage_window)
-                self.logger.debug(f"CPU load temp: {avg_cpu:.3f}, window avg: {window_avg:.3f}")
+                self.logger.debug("CPU load temp: %.3f, window avg: %.3f", avg_cpu, window_avg)
 
                 if len(self._cpu_usage_window) < config.CPU_CHECK_WINDOWSIZE:
                     pass
                 elif window_avg > config.UP_THRESHOLD and self._desired_num_vms < config.MAX_VMS:
                     self._desired_num_vms += 1
                     self.logger.info(f"Increasing desired VMs to {self._desired_num_vms} due to high load")
-                    self._state_changed.set()
+                    self._mark_dirty()
                     await self._autoscale_cooldown()
                 elif window_avg < config.DOWN_THRESHOLD and self._desired_num_vms > config.MIN_VMS:
                     self._desired_num_vms -= 1
                     self.logger.info(f"Decreasing desired VMs to {self._desired_num_vms} due to low load")
-                    self._state_changed.set()
+                    self._mark_dirty()
                     await self._autoscale_cooldown()
 
             except Exception as e:
@@ -323,112 +456,172 @@ class Server:
 
             await asyncio.sleep(config.CPU_LOAD_CHECK)
 
-    async def _healthcheck_task(self, domain: Domain) -> None:
-        self.logger.debug(
-            f"Waiting {config.HEALTHCHECK_START_DELAY}s before starting healthcheck for domain {domain.domain_name}"
-        )
-        await asyncio.sleep(config.HEALTHCHECK_START_DELAY)
+    async def _healthcheck_loop(self) -> None:
+        # one tick probes every domain at once instead of keeping a sleeping task per domain
+        start_delay = datetime.timedelta(seconds=config.HEALTHCHECK_START_DELAY)
         while True:
-            try:
-                await self.healthckeck_single(domain.ip_address, config.HEALTHCHECK_PORT)
-                healthy = True
-            except HealthCheckFailureException as e:
-                self.logger.warning(f"Healthcheck failed for domain {domain.domain_name}: {e}")
-                healthy = False
-            domain = self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name]
-            if healthy and domain.n_success_healthchecks < config.HEALTHCHECK_HEALTHY_THRESHOLD:
-                domain.n_success_healthchecks += 1
-                if domain.n_success_healthchecks >= config.HEALTHCHECK_HEALTHY_THRESHOLD:
-                    domain.state = DomainState.HEALTHY
-                    domain.n_failed_healthchecks = 0
-                    self.logger.info(f"Domain {domain.domain_name} is healthy")
-                self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
-                self._state_changed.set()
-            elif not healthy and domain.n_failed_healthchecks < config.HEALTHCHECK_UNHEALTHY_THRESHOLD:
-                domain.n_failed_healthchecks += 1
-                if domain.n_failed_healthchecks >= config.HEALTHCHECK_UNHEALTHY_THRESHOLD:
-                    domain.state = DomainState.UNHEALTHY
-                    domain.n_success_healthchecks = 0
-                    self.logger.warning(f"Domain {domain.domain_name} is unhealthy, will be destroyed")
-                    self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
-                    self._state_changed.set()
-                self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
-                self._state_changed.set()
-
             await asyncio.sleep(config.HEALTHCHECK_INTERVAL)
+            now = datetime.datetime.now()
+            domains = [
+                domain
+                for domain in self._domains_in_state(DomainState.HEALTHCHECK_INITIALIZING, DomainState.HEALTHY)
+                if domain.started_at is not None and now - domain.started_at >= start_delay
+            ]
+            if not domains:
+                continue
+
+            results = await asyncio.gather(
+                *(self.healthckeck_single(domain.ip_address, config.HEALTHCHECK_PORT) for domain in domains),
+                return_exceptions=True,
+            )
+
+            transitioned = False
+            for domain, result in zip(domains, results):
+                # destroyed or found dead by libvirt while the probe was in flight
+                if domain.state not in (DomainState.HEALTHCHECK_INITIALIZING, DomainState.HEALTHY):
+                    continue
+                healthy = not isinstance(result, Exception)
+                if not healthy:
+                    self.logger.warning(f"Healthcheck failed for domain {domain.domain_name}: {result}")
+                # counter bumps only invalidate the served state, reconciliation cares about transitions
+                if healthy and domain.n_success_healthchecks < config.HEALTHCHECK_HEALTHY_THRESHOLD:
+                    domain.n_success_healthchecks += 1
+                    self._state_bytes = None
+                    if domain.n_success_healthchecks >= config.HEALTHCHECK_HEALTHY_THRESHOLD:
+                        self._set_domain_state(domain, DomainState.HEALTHY)
+                        domain.n_failed_healthchecks = 0
+                        self.logger.info(f"Domain {domain.domain_name} is healthy")
+                        transitioned = True
+                elif not healthy and domain.n_failed_healthchecks < config.HEALTHCHECK_UNHEALTHY_THRESHOLD:
+                    domain.n_failed_healthchecks += 1
+                    self._state_bytes = None
+                    if domain.n_failed_healthchecks >= config.HEALTHCHECK_UNHEALTHY_THRESHOLD:
+                        self._set_domain_state(domain, DomainState.UNHEALTHY)
+                        domain.n_success_healthchecks = 0
+                        self.logger.warning(f"Domain {domain.domain_name} is unhealthy, will be destroyed")
+                        transitioned = True
+            if transitioned:
+                self._mark_dirty()
+
+    def _on_domain_lifecycle_event(
+        self, conn: libvirt.virConnect, dom: libvirt.virDomain, event: int, detail: int, opaque: object
+    ) -> None:
+        if event not in (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED):
+            return
+        domain = self._state["hypervisors"][self.hypervisor_url]["domains"].get(dom.name())
+        if domain is None or domain.state in (DomainState.UNHEALTHY, DomainState.TERMINATING):
+            return
+        self.logger.warning(f"Domain {domain.domain_name} stopped unexpectedly, will be destroyed")
+        self._set_domain_state(domain, DomainState.UNHEALTHY)
+        self._mark_dirty()
+
+    async def _watch_domain_lifecycle(self) -> None:
+        # stopped/crashed domains are reported by libvirt right away instead of waiting
+        # for HEALTHCHECK_UNHEALTHY_THRESHOLD failed TCP probes
+        backoff = config.RECONNECT_BACKOFF
+        while True:
+            try:
+                async with self.connection_context() as conn:
+                    callback_id = await run_libvirt(
+                        conn.domainEventRegisterAny,
+                        None,
+                        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                        self._on_domain_lifecycle_event,
+                        None,
+                    )
+                    backoff = config.RECONNECT_BACKOFF
+                    try:
+                        # the registration dies with the connection, re-register on a fresh one
+                        await self._conn_closed.wait()
+                    finally:
+                        if not self._conn_closed.is_set():
+                            with contextlib.suppress(libvirt.libvirtError):
+                                await run_libvirt(conn.domainEventDeregisterAny, callback_id)
+                # unregister the close callback and close the dead handle before reconnecting
+                await self._close_connection(conn)
+            except libvirt.libvirtError as e:
+                # libvirtd is restarting or unreachable, keep trying instead of taking the server down
+                self.logger.error(
+                    f"Failed to watch domain events on {self.hypervisor_url}: {e}, retrying in {backoff}s"
+                )
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, config.RECONNECT_BACKOFF_MAX)
 
     async def _start_domain_task(self, domain: Domain) -> None:
         try:
-            self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
-            # TODO this should not need to be done manually
-            self._state_changed.set()
-            launched_domain = await self.launch_domain(domain)
-            self._state["hypervisors"][self.hypervisor_url]["domains"][launched_domain.domain_name] = launched_domain
-            self._state_changed.set()
-            self._healthcheck_tasks[launched_domain.domain_name] = asyncio.create_task(
-                self._healthcheck_task(launched_domain),
-                name=f"healthcheck {launched_domain.domain_name}",
-            )
+            await self.launch_domain(domain)
+            self._mark_dirty()
         except Exception as e:
             self.logger.error(f"Failed to launch domain {domain.domain_name}: {e}")
             self.logger.exception(e)
-            del self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name]
-            self._state_changed.set()
+            self._remove_domain(domain)
+            self._mark_dirty()
             raise e
 
     async def _destroy_domain_task(self, domain: Domain) -> None:
         try:
-            domain.state = DomainState.TERMINATING
-            self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name] = domain
-            self._state_changed.set()
-            if domain.domain_name in self._healthcheck_tasks.keys():
-                self.logger.debug(f"Cancelling healthcheck task for domain {domain.domain_name}")
-                self._healthcheck_tasks[domain.domain_name].cancel()
-                del self._healthcheck_tasks[domain.domain_name]
+            self._set_domain_state(domain, DomainState.TERMINATING)
+            self._mark_dirty()
             await self.destroy_domain(domain)
-            del self._state["hypervisors"][self.hypervisor_url]["domains"][domain.domain_name]
+            self._remove_domain(domain)
         except Exception as e:
             self.logger.error(f"Failed to destroy domain {domain.domain_name}: {e}")
             self.logger.exception(e)
             raise e
 
+    def _queue_launch(self, domain: Domain) -> None:
+        # tracked right away so the next pass counts it as running while it waits for a worker
+        self._add_domain(domain)
+        self._launch_queue.put_nowait(domain)
+
+    def _queue_destroy(self, domain: Domain) -> None:
+        # marked right away so the next pass doesn't queue it a second time
+        self._set_domain_state(domain, DomainState.TERMINATING)
+        self._cancel_configure_task(domain)
+        self._destroy_queue.put_nowait(domain)
+
+    async def _domain_worker(self, queue: asyncio.Queue[Domain], task: Callable[[Domain], Awaitable[None]]) -> None:
+        while True:
+            domain = await queue.get()
+            # the task logs its own failures, keep the worker going
+            with contextlib.suppress(Exception):
+                await task(domain)
+
     async def respond_to_state_change(self) -> None:
         while True:
             await self._state_changed.wait()
+            # let a burst of changes (several launches or healthchecks landing together) settle into one pass
+            await asyncio.sleep(config.STATE_CHANGE_DEBOUNCE)
+            self._state_changed.clear()
 
-            unhealthy_domains = [
-                domain
-                for domain in self._state["hypervisors"][self.hypervisor_url]["domains"].values()
-                if domain.state == DomainState.UNHEALTHY
-            ]
+            unhealthy_domains = self._domains_in_state(DomainState.UNHEALTHY)
             for domain in unhealthy_domains:
                 self.logger.warning(f"Domain {domain.domain_name} is unhealthy, destroying")
-                asyncio.create_task(self._destroy_domain_task(domain), name=f"destroy {domain.domain_name}")
+                self._queue_destroy(domain)
 
-            running_domains = [
-                domain
-                for domain in self._state["hypervisors"][self.hypervisor_url]["domains"].values()
-                if domain.state in (DomainState.LAUNCHING, DomainState.HEALTHY, DomainState.HEALTHCHECK_INITIALIZING)
-            ]
-            healthy_domains = [
-                domain
-                for domain in self._state["hypervisors"][self.hypervisor_url]["domains"].values()
-                if domain.state == DomainState.HEALTHY
-            ]
+            running_domains = self._domains_in_state(
+                DomainState.LAUNCHING, DomainState.HEALTHY, DomainState.HEALTHCHECK_INITIALIZING
+            )
+            healthy_domains = self._domains_in_state(DomainState.HEALTHY)
 
             if len(running_domains) < self._desired_num_vms:
                 self.logger.info(
                     f"{len(running_domains)} domains running, {self._desired_num_vms} expected, launching {self._desired_num_vms - len(running_domains)} more..."
                 )
                 for _ in range(self._desired_num_vms - len(running_domains)):
+                    try:
+                        ip_address = self._generate_static_ip()
+                    except RuntimeError as e:
+                        self.logger.error(f"Cannot launch more domains: {e}")
+                        break
                     domain = Domain(
                         n_cpus=2,
                         memory_kib=1024 * 1024 * 5,
                         iso_path=config.ISO_PATH,
-                        ip_address=self._generate_static_ip(subnet="192.168.100"),
+                        ip_address=ip_address,
                         ip_subnet="192.168.100",
                     )
-                    asyncio.create_task(self._start_domain_task(domain), name=f"launch {domain.domain_name}")
+                    self._queue_launch(domain)
             elif len(healthy_domains) > self._desired_num_vms:
                 n_destroy = len(healthy_domains) - self._desired_num_vms
                 self.logger.info(
@@ -436,38 +629,70 @@ class Server:
                 )
                 picks = random.sample(healthy_domains, n_destroy)
                 for domain in picks:
-                    asyncio.create_task(self._destroy_domain_task(domain), name=f"destroy {domain.domain_name}")
+                    self._queue_destroy(domain)
 
-            self._state_changed.clear()
+    async def _refill_disk_pool(self) -> None:
+        try:
+            await self._disk_pool.refill_forever()
+        except Exception as e:
+            # launches fall back to creating their disk inline
+            self.logger.error(f"Disk pool refill stopped: {e}")
+            self.logger.exception(e)
 
     async def _run_jobs(self) -> None:
-        await asyncio.gather(
-            self.respond_to_state_change(),
-            self.run_server(),
-            self._autoscale_loop(),
-        )
+        # kept so shutdown can cancel exactly the jobs, libvirtaio's own timer tasks live on the same loop
+        self._jobs_task = asyncio.current_task()
+        # must be registered before any connection is opened for events to be delivered
+        libvirtaio.virEventRegisterAsyncIOImpl()
+        # unlike gather, a task group cancels the remaining jobs when one of them fails
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.respond_to_state_change())
+            tg.create_task(self.run_server())
+            tg.create_task(self._autoscale_loop())
+            tg.create_task(self._watch_domain_lifecycle())
+            tg.create_task(self._healthcheck_loop())
+            tg.create_task(self._refill_disk_pool())
+            for _ in range(config.DOMAIN_WORKERS):
+                tg.create_task(self._domain_worker(self._launch_queue, self._start_domain_task))
+                tg.create_task(self._domain_worker(self._destroy_queue, self._destroy_domain_task))
+
+    async def _cancel_jobs(self) -> None:
+        # Runner.run doesn't cancel a job task left pending by SIGTERM the way asyncio.run did;
+        # stop it and the configure tasks before cleanup so workers can't launch domains while
+        # they're being destroyed
+        tasks: list[asyncio.Task[object]] = [*self._configure_tasks.values()]
+        if self._jobs_task is not None:
+            tasks.append(self._jobs_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     async def _cleanup(self) -> None:
+        # no point configuring domains that are about to be destroyed
+        await self._cancel_jobs()
+        # domains first, the network can't go away while they're still attached to it;
+        # launches and destroys cut short by the cancellation may have left a domain behind too
         await asyncio.gather(
-            *(
-                self._destroy_domain_task(domain)
-                for domain in self._state["hypervisors"][self.hypervisor_url]["domains"].values()
-                if domain.state not in (DomainState.TERMINATING, DomainState.LAUNCHING)
-            ),
-            self.destroy_nat_network("wso-net"),
+            *(self._destroy_domain_task(domain) for domain in self._domains_in_state(*DomainState)),
+            return_exceptions=True,
         )
+        await self.destroy_nat_network("wso-net")
+        await self._close_connection()
 
     def serve_forever(self) -> None:
         self.logger.info(f"Server running with PID {os.getpid()}")
-        try:
-            asyncio.run(self._run_jobs())
-        except KeyboardInterrupt:
-            self.logger.info("Received keyboard interrupt, shutting down the domain")
-            sys.exit(0)
-        except Exception as e:
-            self.logger.fatal(f"An error occurred: {e}; aborting")
-            self.logger.exception(e)
-            sys.exit(1)
-        finally:
-            asyncio.run(self._cleanup())
-            self.logger.info(f"Server PID {os.getpid()} terminated")
+        # cleanup runs on the same loop as the jobs instead of setting up a second one
+        with asyncio.Runner() as runner:
+            try:
+                runner.run(self._run_jobs())
+            except KeyboardInterrupt:
+                self.logger.info("Received keyboard interrupt, shutting down the domain")
+                sys.exit(0)
+            except Exception as e:
+                self.logger.fatal(f"An error occurred: {e}; aborting")
+                self.logger.exception(e)
+                sys.exit(1)
+            finally:
+                runner.run(self._cleanup())
+                shutdown_libvirt_executor()
+                self.logger.info(f"Server PID {os.getpid()} terminated")
@@ -1,59 +1,93 @@
+import atexit
 import dataclasses
 import functools
 import json
 import logging
 import logging.handlers
 import os
+import queue
 import sys
 from datetime import datetime
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import wso.config
 
+_LOG_FORMATTER = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+
 
-@functools.lru_cache()
 def get_logger(level: int = logging.DEBUG, log_file: str | os.PathLike | None = None) -> logging.Logger:
     logger = logging.getLogger("wso")
     logger.setLevel(level=level)
-    sh = logging.StreamHandler(sys.stdout)
-    s_format = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-    sh.setFormatter(s_format)
-    logger.addHandler(sh)
+    # "wso" is a process-wide singleton, attach the queue handler and start the listener only once
+    # no matter which arguments later callers pass
+    if logger.handlers:
+        return logger
+    handlers: list[logging.Handler] = []
     if log_file:
         fh = logging.handlers.RotatingFileHandler(log_file, maxBytes=10**6, backupCount=5)
-        f_format = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-        fh.setFormatter(f_format)
-        logger.addHandler(fh)
+        fh.setFormatter(_LOG_FORMATTER)
+        handlers.append(fh)
+    # headless runs above INFO log to the file only, nobody reads the piped stdout
+    if not handlers or level <= logging.INFO or sys.stdout.isatty():
+        sh = logging.StreamHandler(sys.stdout)
+        sh.setFormatter(_LOG_FORMATTER)
+        handlers.append(sh)
+    # stdout/file writes happen on the listener thread, callers on the event loop only enqueue the record
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     return logger
 
 
+@functools.cache
+def _field_names(cls: type) -> tuple[str, ...]:
+    return tuple(field.name for field in dataclasses.fields(cls))
+
+
+# leaf types by exact type, one dict lookup instead of an isinstance chain per value
+_ENCODERS: dict[type, Callable[[Any], Any]] = {
+    type(Path()): os.fspath,
+    datetime: datetime.isoformat,
+}
+
+
 class EnhancedJSONEncoder(json.JSONEncoder):
     def default(self, o: Any) -> Any:
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)  # type: ignore[arg-type]
-        elif isinstance(o, Path):
-            return str(o.resolve().absolute())
-        elif isinstance(o, datetime):
-            return str(o.isoformat())
+        encoder = _ENCODERS.get(type(o))
+        if encoder is not None:
+            return encoder(o)
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            # shallow, nested values come back through default() instead of asdict's deep copy
+            return {name: getattr(o, name) for name in _field_names(type(o))}
+        # subclasses miss the exact-type table
+        if isinstance(o, Path):
+            return os.fspath(o)
+        if isinstance(o, datetime):
+            return o.isoformat()
         return super().default(o)
 
 
+@functools.cache
 def get_ssh_public_key() -> str:
     """
-    Returns the SSH public key from the default location.
+    Returns the SSH public key from the default location. The key is read once per process.
     """
     if wso.config.SSH_KEY_PATH is None:
         ssh_dir = Path.home() / ".ssh"
+        # open() is the existence check, no separate stat per candidate
         for key_name in ["id_ed25519.pub", "id_rsa.pub"]:
-            public_key_path = ssh_dir / key_name
-            if public_key_path.is_file():
-                break
-        else:
-            raise FileNotFoundError("No SSH public key found (tried id_ed25519.pub and id_rsa.pub)")
-    else:
-        public_key_path = Path(wso.config.SSH_KEY_PATH).with_suffix(".pub")
-        if not public_key_path.is_file():
-            raise FileNotFoundError(f"SSH public key file {public_key_path} does not exist or is not a file.")
-    with open(public_key_path, "r") as f:
-        return f.read().strip()
+            try:
+                with open(ssh_dir / key_name, "r") as f:
+                    return f.read().strip()
+            except (FileNotFoundError, IsADirectoryError):
+                continue
+        raise FileNotFoundError("No SSH public key found (tried id_ed25519.pub and id_rsa.pub)")
+    public_key_path = Path(wso.config.SSH_KEY_PATH).with_suffix(".pub")
+    try:
+        with open(public_key_path, "r") as f:
+            return f.read().strip()
+    except (FileNotFoundError, IsADirectoryError) as e:
+        raise FileNotFoundError(f"SSH public key file {public_key_path} does not exist or is not a file.") from e